@@ -1,19 +1,14 @@
 """Main agent loop and UI."""
 
 import asyncio
-
-try:
-    import uvloop
-
-    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
-except ImportError:
-    pass
-
 import os
+import sys
 import json
 import time
 import logging
 import html
+import hashlib
+import uuid
 from prompt_toolkit import PromptSession, print_formatted_text
 from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.formatted_text import HTML, FormattedText
@@ -28,9 +23,11 @@ from prompt_toolkit.key_binding.vi_state import InputMode
 from pygments.lexers.markup import MarkdownLexer
 
 from .config import config
+from .cache import evict, forget_archive
 from .llm import call_llm
-from .tools import TOOLS, TOOL_SCHEMAS, save_clipboard_image
+from .tools import TOOLS, TOOL_SCHEMAS, READ_ONLY_TOOLS, save_clipboard_image
 from .undo import UndoManager
+from .utils import json_loads
 
 # ---------------------------------------------------------------------------
 # Setup
@@ -44,11 +41,13 @@ if "AGENT_WORK_DIR" in os.environ:
 class PTKHandler(logging.Handler):
     """Logging handler that uses prompt_toolkit for output."""
 
+    STYLES = {logging.ERROR: "ansired", logging.WARNING: "ansiyellow"}
+
     def emit(self, record):
         try:
-            msg = html.escape(self.format(record))
-            color = {logging.ERROR: "ansired", logging.WARNING: "ansiyellow"}.get(record.levelno, "ansiwhite")
-            print_formatted_text(HTML(f"<{color}>{msg}</{color}>"))
+            # Style/text tuples go straight to the renderer: no escaping or markup parsing
+            style = self.STYLES.get(record.levelno, "ansiwhite")
+            print_formatted_text(FormattedText([(style, self.format(record))]))
         except Exception:
             self.handleError(record)
 
@@ -61,6 +60,22 @@ logging.getLogger().addHandler(handler)
 logging.getLogger().setLevel(logging.DEBUG if config.debug else logging.INFO)
 logger = logging.getLogger("Agent")
 
+MARKDOWN_LEXER = PygmentsLexer(MarkdownLexer)
+PROMPT_STYLE = Style.from_dict({"prompt": "ansicyan bold"})
+PREVIEW_LIMIT = 512  # Max argument chars shown per tool call preview in auto mode
+
+# Fixed markup is parsed once at import instead of on every print or redraw
+USER_PROMPT = HTML("<b>User (Alt+Enter: Send, Alt+E: Editor, Alt+I: Image, Alt+Z: Undo, Ctrl+D: Exit):</b>\n")
+APPROVAL_PROMPT = HTML("<ansicyan>Execute? [Y/n]: </ansicyan>")
+TOOLS_CANCELLED = HTML("\n<ansiyellow>Tool execution cancelled.</ansiyellow>")
+STATUS_THINKING = HTML(" <ansigreen>Thinking...</ansigreen> (Ctrl+W: stop, Ctrl+C: cancel)")
+STATUS_STOPPING = HTML(" <ansiyellow>Stopping...</ansiyellow> (Ctrl+C to force)")
+MODE_LABELS = {
+    InputMode.INSERT: HTML(" <b>[INSERT]</b>"),
+    InputMode.NAVIGATION: HTML(" <b>[COMMAND]</b>"),
+    InputMode.REPLACE: HTML(" <b>[REPLACE]</b>"),
+}
+
 # ---------------------------------------------------------------------------
 # System Prompt
 # ---------------------------------------------------------------------------
@@ -106,8 +121,14 @@ For debugging and investigation:
 messages = [{"role": "system", "content": SYSTEM_PROMPT}]
 undo_manager = UndoManager()
 total_cost = 0.0
-last_request_time = 0.0
+last_request_ns = 0
 has_seen_cached_tokens = False
+approval_session = None
+status_app = None
+turn_state = {"stop_requested": False, "task": None}
+tool_semaphore = asyncio.Semaphore(config.tool_parallelism)
+sent_prefix = {"length": 0, "digest": None}
+cache_stats = {"reads": 0, "creates": 0, "miss_turns": 0, "hit_length": 0}
 
 # Wrap update_file to track changes for undo
 _original_update_file = TOOLS["update_file"]
@@ -125,14 +146,15 @@ TOOLS["update_file"] = _tracked_update_file
 # ---------------------------------------------------------------------------
 
 
-def display_usage(usage: dict, elapsed_minutes: float):
-    """Display cost and cache information."""
+def display_usage(usage: dict, elapsed_ns: int):
+    """Display cost and cache information (elapsed_ns: time since the previous request)."""
     global total_cost, has_seen_cached_tokens
 
+    lines = []
     cost = usage.get("cost", 0)
     if cost:
         total_cost += cost
-        print_formatted_text(HTML(f"<ansicyan>Cost: ${cost:.6f} | Total: ${total_cost:.6f}</ansicyan>"))
+        lines.append(f"<ansicyan>Cost: ${cost:.6f} | Total: ${total_cost:.6f}</ansicyan>")
 
     cached = (
         usage.get("cachedContentTokenCount", 0)
@@ -143,80 +165,167 @@ def display_usage(usage: dict, elapsed_minutes: float):
     created = usage.get("cache_creation_input_tokens", 0)
 
     if cached or created:
-        print_formatted_text(HTML(f"<ansigreen>Cache: {cached} read, {created} created</ansigreen>"))
+        lines.append(f"<ansigreen>Cache: {cached} read, {created} created</ansigreen>")
+
+    cache_stats["reads"] += cached
+    cache_stats["creates"] += created
 
     if cached > 0:
         has_seen_cached_tokens = True
+        cache_stats["hit_length"] = len(messages)
     elif has_seen_cached_tokens:
+        cache_stats["miss_turns"] += 1
         ttl = 60.0 if config.provider == "gemini" else 5.0
+        elapsed_minutes = elapsed_ns / 60_000_000_000
         reason = "Prefix mismatch" if elapsed_minutes < ttl - 1 else "Cache TTL expired"
-        print_formatted_text(HTML(f"<ansired>WARNING: Cache dropped to 0! ({reason})</ansired>"))
+        lines.append(f"<ansired>WARNING: Cache dropped to 0! ({reason})</ansired>")
+        if logger.isEnabledFor(logging.DEBUG):
+            added = [m["role"] for m in messages[cache_stats["hit_length"] :]][-3:]
+            logger.debug("Cache miss; last roles added since previous hit: %s", added)
+
+    if lines:
+        print_formatted_text(HTML("\n".join(lines)))
+
+
+def display_cache_summary():
+    """Display session-wide prompt cache totals."""
+    if cache_stats["reads"] or cache_stats["creates"] or cache_stats["miss_turns"]:
+        print_formatted_text(
+            HTML(
+                f"<ansigreen>Cache totals: {cache_stats['reads']} read, {cache_stats['creates']} created, "
+                f"{cache_stats['miss_turns']} miss(es)</ansigreen>"
+            )
+        )
+
+
+def assistant_message(msg: dict) -> dict:
+    """Build the assistant history entry with a fixed key order.
+
+    Replayed history must stay byte-identical for provider prompt caches to hit, so
+    keys are emitted in a canonical order and every tool call gets a stable id.
+    """
+    for tc in msg.get("tool_calls") or []:
+        if not tc.get("id"):
+            tc["id"] = f"call_{uuid.uuid4().hex}"
+    entry = {
+        "role": "assistant",
+        "content": msg.get("content") or "",
+        "tool_calls": msg.get("tool_calls"),
+        "reasoning": msg.get("reasoning"),
+        "reasoning_details": msg.get("reasoning_details"),
+    }
+    return {k: v for k, v in entry.items() if k == "content" or v}
+
+
+def tool_result(tc: dict, content: str) -> dict:
+    """Build the tool history entry answering a tool call."""
+    return {"role": "tool", "tool_call_id": tc["id"], "name": tc["function"]["name"], "content": content}
+
+
+def check_prefix_stability():
+    """Debug aid: warn when messages already sent to the provider were modified since."""
+    length = sent_prefix["length"]
+    if len(messages) < length:
+        # History was rewound (undo); start tracking afresh
+        sent_prefix.update(length=0, digest=None)
+        return
+    digest = hashlib.sha1(json.dumps(messages[:length]).encode()).hexdigest()
+    if sent_prefix["digest"] and digest != sent_prefix["digest"]:
+        logger.warning("Sent message prefix changed since the last request; prompt cache will miss.")
+
+
+def record_sent_prefix():
+    """Remember a digest of the messages just sent (after provider-side cache marking)."""
+    sent_prefix["length"] = len(messages)
+    sent_prefix["digest"] = hashlib.sha1(json.dumps(messages).encode()).hexdigest()
+
+
+def tool_preview(tc: dict) -> FormattedText:
+    """Format a tool call as name(arguments), showing the raw argument JSON as received.
+
+    Only auto mode shortens long arguments: in manual mode this is what the user approves.
+    """
+    args = tc["function"]["arguments"] or "{}"
+    if config.mode != "manual" and len(args) > PREVIEW_LIMIT:
+        args = args[:PREVIEW_LIMIT] + "..."
+    return FormattedText([("bold", f"  {tc['function']['name']}"), ("", f"({args})")])
+
+
+async def run_tool(tc: dict) -> str:
+    """Execute a single tool call and return its result as a string."""
+    name = tc["function"]["name"]
+    tool = TOOLS.get(name)
+    if tool is None:
+        return f"Error: Tool '{name}' not found."
+
+    try:
+        arguments = tc["function"]["arguments"]
+        if not arguments:
+            args = {}
+        elif len(arguments) > 65536:
+            # Whole-file payloads: keep the loop free to service Ctrl+W/Ctrl+C
+            args = await asyncio.to_thread(json_loads, arguments)
+        else:
+            args = json_loads(arguments)
+        logger.debug("Executing %s with %.2000s", name, args)
+        async with tool_semaphore:
+            result = await tool(**args)
+    except Exception as e:
+        result = f"Error: {e}"
+        logger.error(f"Tool error: {e}")
+    return str(result)
 
 
 async def execute_tools(tool_calls: list):
     """Execute tool calls and add results to messages."""
-    print_formatted_text(HTML("\n<ansiyellow>Tool Calls:</ansiyellow>"))
+    global approval_session
+    listing = [("", "\n"), ("class:ansiyellow", "Tool Calls:")]
+    for tc in tool_calls:
+        listing += [("", "\n"), *tool_preview(tc)]
+    print_formatted_text(FormattedText(listing))
 
     # In manual mode, ask for approval before executing tools
     if config.mode == "manual":
-        for tc in tool_calls:
-            name = tc["function"]["name"]
-            args = json.loads(tc["function"]["arguments"]) if tc["function"]["arguments"] else {}
-            print_formatted_text(FormattedText([("bold", f"  {name}"), ("", f"({json.dumps(args)})")]))
-
         try:
-            approval_session = PromptSession()
-            response = await approval_session.prompt_async(
-                HTML("<ansicyan>Execute? [Y/n]: </ansicyan>")
-            )
+            # Reused across batches (created lazily: needs a terminal)
+            approval_session = approval_session or PromptSession()
+            response = await approval_session.prompt_async(APPROVAL_PROMPT)
             response = response.strip().lower()
             if response in ("n", "no"):
-                print_formatted_text(HTML("<ansiyellow>Tool execution cancelled.</ansiyellow>"))
+                print_formatted_text(TOOLS_CANCELLED)
                 for tc in tool_calls:
-                    messages.append({
-                        "role": "tool",
-                        "tool_call_id": tc.get("id", "unknown"),
-                        "name": tc["function"]["name"],
-                        "content": "Tool execution cancelled by user."
-                    })
+                    messages.append(tool_result(tc, "Tool execution cancelled by user."))
                 return
         except (EOFError, KeyboardInterrupt):
-            print_formatted_text(HTML("\n<ansiyellow>Tool execution cancelled.</ansiyellow>"))
+            print_formatted_text(TOOLS_CANCELLED)
             for tc in tool_calls:
-                messages.append({
-                    "role": "tool",
-                    "tool_call_id": tc.get("id", "unknown"),
-                    "name": tc["function"]["name"],
-                    "content": "Tool execution cancelled by user."
-                })
+                messages.append(tool_result(tc, "Tool execution cancelled by user."))
             return
 
+    # Calls in one batch are independent; run them concurrently, record results in order.
+    # Identical read-only calls run once and every tool_call_id gets the shared result.
+    runs, tc_runs = {}, []
     for tc in tool_calls:
-        name = tc["function"]["name"]
-        args = json.loads(tc["function"]["arguments"]) if tc["function"]["arguments"] else {}
-
-        if config.mode == "auto":
-            print_formatted_text(FormattedText([("bold", f"  {name}"), ("", f"({json.dumps(args)})")]))
-        logger.debug(f"Executing {name} with {args}")
-
-        if name in TOOLS:
-            try:
-                result = await TOOLS[name](**args)
-            except Exception as e:
-                result = f"Error: {e}"
-                logger.error(f"Tool error: {e}")
-        else:
-            result = f"Error: Tool '{name}' not found."
-
-        messages.append({"role": "tool", "tool_call_id": tc.get("id", "unknown"), "name": name, "content": str(result)})
-        print_formatted_text(FormattedText([("#888888", f"Result: {str(result)[:100]}...")]))
+        name, arguments = tc["function"]["name"], tc["function"]["arguments"]
+        key = (name, arguments) if name in READ_ONLY_TOOLS else tc["id"]
+        if key not in runs:
+            runs[key] = asyncio.create_task(run_tool(tc))
+        tc_runs.append(runs[key])
+    results = await asyncio.gather(*tc_runs)
+    for tc, result in zip(tool_calls, results):
+        messages.append(tool_result(tc, result))
+    print_formatted_text(FormattedText([("#888888", "\n".join(f"Result: {r[:100]}..." for r in results))]))
 
 
 async def process_turn_logic(user_input: str, stop_check=None):
     """Process a single turn of conversation."""
-    global last_request_time
+    global last_request_ns
 
     undo_manager.start_turn(messages)
+    archived = evict(messages)
+    if archived:
+        undo_manager.record_replaced(archived)
+        sent_prefix.update(length=0, digest=None)
     messages.append({"role": "user", "content": user_input})
 
     while True:
@@ -224,9 +333,13 @@ async def process_turn_logic(user_input: str, stop_check=None):
             print_formatted_text(HTML("\n<ansiyellow>Stopping after current step.</ansiyellow>"))
             break
 
-        request_time = time.time()
-        elapsed = (request_time - last_request_time) / 60.0 if last_request_time else 0
-        last_request_time = request_time
+        # Monotonic: wall-clock jumps must not fake cache TTL expiry
+        request_ns = time.monotonic_ns()
+        elapsed_ns = request_ns - last_request_ns if last_request_ns else 0
+        last_request_ns = request_ns
+
+        if config.debug:
+            check_prefix_stability()
 
         try:
             response = await call_llm(messages, TOOL_SCHEMAS)
@@ -237,27 +350,24 @@ async def process_turn_logic(user_input: str, stop_check=None):
             print_formatted_text(HTML(f"\n<ansired>Error: {e}</ansired>"))
             break
 
+        if config.debug:
+            record_sent_prefix()
+
         msg = response["message"]
         if response.get("usage"):
-            display_usage(response["usage"], elapsed)
-
-        # Display reasoning if present
-        if msg.get("reasoning"):
-            print_formatted_text(HTML(f"\n<style fg='#888888'>{html.escape(msg['reasoning'][:500])}...</style>"))
+            display_usage(response["usage"], elapsed_ns)
 
         # Add assistant message (preserve reasoning_details for Gemini via OpenRouter)
-        assistant_msg = {"role": "assistant", "content": msg.get("content") or ""}
-        if msg.get("tool_calls"):
-            assistant_msg["tool_calls"] = msg["tool_calls"]
-        if msg.get("reasoning"):
-            assistant_msg["reasoning"] = msg["reasoning"]
-        if msg.get("reasoning_details"):
-            assistant_msg["reasoning_details"] = msg["reasoning_details"]
-        messages.append(assistant_msg)
+        messages.append(assistant_message(msg))
 
-        # Display response
+        # Display reasoning and response together (plain fragments: nothing to escape or parse)
+        output = []
+        if msg.get("reasoning"):
+            output.append(("#888888", f"\n{msg['reasoning'][:500]}..."))
         if msg.get("content"):
-            print_formatted_text(HTML(f"\n<ansigreen>Assistant:</ansigreen>\n{html.escape(msg['content'])}"))
+            output += [("", "\n"), ("ansigreen", "Assistant:"), ("", "\n" + msg["content"])]
+        if output:
+            print_formatted_text(FormattedText(output))
 
         # Handle tool calls or finish
         if msg.get("tool_calls"):
@@ -266,40 +376,42 @@ async def process_turn_logic(user_input: str, stop_check=None):
             break
 
 
-async def process_turn(user_input: str):
-    """Process turn with UI wrapper for cancellation."""
+def build_status_app() -> Application:
+    """Build the one-line status UI shown while a turn runs (reused across turns)."""
     kb = KeyBindings()
-    stop_requested = False
-    task = None
 
     @kb.add("c-w")
     def _(event):
-        nonlocal stop_requested
-        stop_requested = True
+        turn_state["stop_requested"] = True
 
     @kb.add("c-c")
     def _(event):
-        if task:
-            task.cancel()
+        if turn_state["task"]:
+            turn_state["task"].cancel()
 
     def status():
-        if stop_requested:
-            return HTML(" <ansiyellow>Stopping...</ansiyellow> (Ctrl+C to force)")
-        return HTML(" <ansigreen>Thinking...</ansigreen> (Ctrl+W: stop, Ctrl+C: cancel)")
+        return STATUS_STOPPING if turn_state["stop_requested"] else STATUS_THINKING
+
+    return Application(layout=Layout(Window(FormattedTextControl(status), height=1)), key_bindings=kb)
 
-    app = Application(layout=Layout(Window(FormattedTextControl(status), height=1)), key_bindings=kb)
+
+async def process_turn(user_input: str):
+    """Process turn with UI wrapper for cancellation."""
+    global status_app
+    status_app = status_app or build_status_app()
+    app = status_app
+    turn_state.update(stop_requested=False, task=None)
 
     async def run():
-        nonlocal task
         try:
-            await process_turn_logic(user_input, lambda: stop_requested)
+            await process_turn_logic(user_input, lambda: turn_state["stop_requested"])
         except asyncio.CancelledError:
             print_formatted_text(HTML("\n<ansired>Interrupted.</ansired>"))
         finally:
             app.exit()
 
     with patch_stdout():
-        task = asyncio.create_task(run())
+        task = turn_state["task"] = asyncio.create_task(run())
         await app.run_async()
         if not task.done():
             task.cancel()
@@ -315,10 +427,17 @@ async def process_turn(user_input: str):
 
 
 async def main():
-    print_formatted_text(HTML(f"<ansicyan>Agent started ({config.mode} mode, {config.model})</ansicyan>"))
+    banner = f"<ansicyan>Agent started ({config.mode} mode, {config.model})</ansicyan>"
+    if config.initial_prompt:
+        banner += "\n\n<ansicyan>Executing initial prompt...</ansicyan>"
+    print_formatted_text(HTML(banner))
 
     if config.initial_prompt:
-        print_formatted_text(HTML("\n<ansicyan>Executing initial prompt...</ansicyan>"))
+        if not sys.stdin.isatty():
+            # Scripted run: nobody to drive the status UI or the prompt loop
+            await process_turn_logic(config.initial_prompt)
+            display_cache_summary()
+            return
         await process_turn(config.initial_prompt)
 
     kb = KeyBindings()
@@ -326,10 +445,13 @@ async def main():
     @kb.add("escape", "z")
     def _(event):
         last_user = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
-        restored = undo_manager.undo()
+        restored = undo_manager.undo(messages)
         if restored:
             messages[:] = restored
-            event.current_buffer.text = last_user if isinstance(last_user, str) else ""
+            forget_archive()  # Undo may have put archived originals back
+            if isinstance(last_user, list):  # Cache-marked or image message: keep its text blocks
+                last_user = "".join(b["text"] for b in last_user if b.get("type") == "text")
+            event.current_buffer.text = last_user
             print_formatted_text(HTML("\n<ansiyellow>Undone last turn.</ansiyellow>"))
         else:
             print_formatted_text(HTML("\n<ansired>Nothing to undo.</ansired>"))
@@ -352,20 +474,19 @@ async def main():
         key_bindings=kb,
         vi_mode=True,
         multiline=True,
-        lexer=PygmentsLexer(MarkdownLexer),
-        style=Style.from_dict({"prompt": "ansicyan bold"}),
+        lexer=MARKDOWN_LEXER,
+        style=PROMPT_STYLE,
     )
 
     def toolbar():
         mode = session.app.vi_state.input_mode
-        labels = {InputMode.INSERT: "INSERT", InputMode.NAVIGATION: "COMMAND", InputMode.REPLACE: "REPLACE"}
-        return HTML(f" <b>[{labels.get(mode, mode)}]</b>")
+        return MODE_LABELS.get(mode) or HTML(f" <b>[{html.escape(str(mode))}]</b>")
 
     while True:
         try:
             user_input = await session.prompt_async(
-                HTML("<b>User (Alt+Enter: Send, Alt+E: Editor, Alt+I: Image, Alt+Z: Undo, Ctrl+D: Exit):</b>\n"),
-                bottom_toolbar=toolbar,
+                USER_PROMPT,
+                bottom_toolbar=toolbar if sys.stdout.isatty() else None,
             )
             if user_input.strip().lower() == "exit":
                 break
@@ -376,6 +497,18 @@ async def main():
         except EOFError:
             break
 
+    display_cache_summary()
+
+
+def run():
+    """Console entry point: run the agent on uvloop when available."""
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
+
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    run()
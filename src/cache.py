@@ -1,60 +1,207 @@
-"""Anthropic prompt caching management for OpenRouter."""
+"""Prompt cache management: Anthropic cache markers for OpenRouter and history eviction."""
 
 import logging
 
+from .utils import json_dumps
+
 logger = logging.getLogger(__name__)
 
+# Add checkpoints every N messages (max 2 for history, keeping 2 for system+tail)
+CHECKPOINT_INTERVAL = 8
+MAX_HISTORY_CHECKPOINTS = 2
+CHECKPOINT_OFFSETS = (0, -1, 1, -2, 2)  # Probe order around an interval boundary
+MIN_CACHEABLE_TOKENS = 1024  # Anthropic doesn't cache shorter prefixes, so markers would be wasted
+
+
+class _CacheState:
+    """Checkpoint bookkeeping carried between calls, so each call only scans new messages."""
+
+    def __init__(self):
+        self.system = None  # System message already carrying its marker (it never changes)
+        self.reset()
+
+    def reset(self, messages: list = None):
+        self.messages = messages  # The history list this state describes
+        self.scanned = 0  # Messages [0, scanned) have been considered for checkpoints
+        self.last = None  # messages[scanned - 1] when scanned, to detect rewrites
+        self.checkpoints = []  # History checkpoint indices, oldest first
+        self.has_content = []  # Per-message flag, parallel to messages[:scanned]
+        self.chars = 0  # Text length of messages[:scanned], for a chars/4 token estimate
+        self.marked = set()  # Indices after the system prompt carrying a cache_control marker
+        if messages:
+            self.marked = {i for i, m in enumerate(messages) if i > 0 and _marker_blocks(m)}
+
+    def is_current(self, messages: list) -> bool:
+        """Whether messages only grew (by appends) since the last call."""
+        if messages is not self.messages or len(messages) < self.scanned:
+            return False
+        return self.scanned == 0 or messages[self.scanned - 1] is self.last
+
+
+def _has_content(m: dict) -> bool:
+    """Whether a message has non-empty text or block content."""
+    return bool(m.get("content")) and isinstance(m["content"], (str, list))
+
+
+def _char_count(m: dict) -> int:
+    """Approximate text length of a message (content blocks and tool call arguments)."""
+    content = m.get("content")
+    if isinstance(content, str):
+        count = len(content)
+    elif isinstance(content, list):
+        count = sum(len(b.get("text") or b.get("image_url", {}).get("url", "")) for b in content)
+    else:
+        count = 0
+    return count + sum(len(tc["function"]["arguments"]) for tc in m.get("tool_calls") or [])
+
+
+def _marker_blocks(m: dict) -> list:
+    """Content blocks of a message that carry a cache_control marker."""
+    if not isinstance(m["content"], list):
+        return []
+    return [b for b in m["content"] if b.get("cache_control")]
+
+
+def _mark(msg: dict):
+    """Attach a cache_control breakpoint to the last content block of a message."""
+    if isinstance(msg["content"], str):
+        msg["content"] = [{"type": "text", "text": msg["content"], "cache_control": {"type": "ephemeral"}}]
+    elif isinstance(msg["content"], list) and msg["content"]:
+        msg["content"][-1]["cache_control"] = {"type": "ephemeral"}
+
+
+def _unmark(msg: dict):
+    for block in _marker_blocks(msg):
+        block.pop("cache_control", None)
+    # Undo _mark's string-to-block rewrite, so readers of the history see the text again
+    content = msg["content"]
+    if len(content) == 1 and content[0].keys() == {"type", "text"} and content[0]["type"] == "text":
+        msg["content"] = content[0]["text"]
+
+
+_state = _CacheState()
 
-def apply_anthropic_cache(messages: list, model: str):
-    """Apply Anthropic cache_control markers to messages (mutates in-place)."""
-    if "anthropic" not in model.lower() and "claude" not in model.lower():
-        return
 
-    # Cache system prompt
-    for msg in messages:
-        if msg["role"] == "system":
-            if isinstance(msg["content"], str):
-                msg["content"] = [{"type": "text", "text": msg["content"], "cache_control": {"type": "ephemeral"}}]
-            elif isinstance(msg["content"], list) and msg["content"]:
-                if not any(b.get("cache_control") for b in msg["content"]):
-                    msg["content"][-1]["cache_control"] = {"type": "ephemeral"}
-            break
-
-    # Add checkpoints every N messages (max 2 for history, keeping 2 for system+tools)
-    CHECKPOINT_INTERVAL = 8
-    MAX_HISTORY_CHECKPOINTS = 2
-
-    candidates = [i for i, m in enumerate(messages) if m["role"] != "system" and i > 0 and i % CHECKPOINT_INTERVAL == 0]
-
-    # Find valid checkpoint indices (messages with content)
-    checkpoints = []
-    for idx in candidates:
-        for offset in [0, -1, 1, -2, 2]:
+def apply_anthropic_cache(messages: list, tools_chars: int = 0):
+    """Apply Anthropic cache_control markers to messages (mutates in-place).
+
+    Callers only invoke this for Anthropic models (OpenRouter resolves the family once per model id).
+    Breakpoints (Anthropic allows 4): the system prompt, which also covers the tool
+    definitions preceding it, up to 2 periodic history checkpoints, and the newest
+    message so the next round trip of the same turn reads everything sent so far.
+    Nothing is marked until the prompt (plus tools_chars of tool definitions) is
+    estimated to reach Anthropic's minimum cacheable length.
+    """
+    # Rescan from scratch only if the history was rewound or replaced (undo, another list)
+    state = _state
+    if not state.is_current(messages):
+        state.reset(messages)
+
+    # Content flags are computed once per message; the loops below only read this table
+    has_content = state.has_content
+    has_content.extend(_has_content(m) for m in messages[state.scanned :])
+    state.chars += sum(_char_count(m) for m in messages[state.scanned :])
+
+    # Pick a checkpoint near each new interval boundary (messages with content)
+    count = len(messages)
+    chosen = set(state.checkpoints)
+    first = max(state.scanned, 1)
+    for idx in range(first + (-first % CHECKPOINT_INTERVAL), count, CHECKPOINT_INTERVAL):
+        for offset in CHECKPOINT_OFFSETS:
             check_idx = idx + offset
-            if 0 < check_idx < len(messages):
-                m = messages[check_idx]
-                has_content = m.get("content") and (
-                    isinstance(m["content"], str) or (isinstance(m["content"], list) and m["content"])
-                )
-                if has_content and check_idx not in checkpoints:
-                    checkpoints.append(check_idx)
-                    break
-
-    checkpoints = checkpoints[-MAX_HISTORY_CHECKPOINTS:]
-
-    # Apply/remove cache markers
-    for i, msg in enumerate(messages):
-        if msg["role"] == "system":
+            if 0 < check_idx < count and check_idx not in chosen and has_content[check_idx]:
+                state.checkpoints.append(check_idx)
+                chosen.add(check_idx)
+                break
+    state.checkpoints = state.checkpoints[-MAX_HISTORY_CHECKPOINTS:]
+    state.scanned = count
+    state.last = messages[-1] if messages else None
+
+    if (state.chars + tools_chars) // 4 < MIN_CACHEABLE_TOKENS:
+        return
+
+    # Cache system prompt (callers only ever put it first)
+    system = messages[0] if messages and messages[0]["role"] == "system" else None
+    if system and system is not state.system:
+        if not _marker_blocks(system):
+            _mark(system)
+        state.system = system
+
+    wanted = set(state.checkpoints)
+
+    # Tail breakpoint: newest message with content (user input or last tool result)
+    tail = next((i for i in range(count - 1, 0, -1) if has_content[i]), None)
+    if tail is not None:
+        wanted.add(tail)
+
+    # Apply/remove cache markers only where the set changed
+    for i in state.marked - wanted:
+        _unmark(messages[i])
+    for i in wanted - state.marked:
+        _mark(messages[i])
+    state.marked = wanted
+
+
+# History eviction: old tool output is archived in batches, so the cached prefix
+# changes once per batch instead of on every turn
+ARCHIVE_THRESHOLD = 120  # Unarchived messages allowed before a batch is archived
+ARCHIVE_KEEP = 40  # Newest messages a batch leaves untouched
+ARCHIVED_OUTPUT = "[Tool output archived to bound context size.]"
+# Tool call arguments longer than this (update_file carries whole files) are archived too
+ARCHIVE_ARGUMENTS_OVER = 256
+ARCHIVED_ARGUMENTS = json_dumps({"archived": "[Arguments archived to bound context size.]"})
+
+_archive = {"messages": None, "upto": 1}
+
+
+def evict(messages: list) -> dict:
+    """Archive old tool output and long tool call arguments, and drop old reasoning.
+
+    Message dicts are replaced, not mutated. Tool messages keep their role, name and
+    tool_call_id, and tool calls their id and name, so call/result pairing stays
+    valid; failed calls keep their first line. Returns {index: original message} for
+    everything replaced (empty if nothing was), so undo can put the originals back.
+    """
+    if _archive["messages"] is not messages or _archive["upto"] > len(messages):
+        _archive.update(messages=messages, upto=1)
+
+    start, end = _archive["upto"], len(messages) - ARCHIVE_KEEP
+    if len(messages) - start <= ARCHIVE_THRESHOLD:
+        return {}
+
+    replaced = {}
+    for i in range(start, end):
+        m = messages[i]
+        if m["role"] == "assistant":
+            tool_calls = m.get("tool_calls") or []
+            long_args = [len(tc["function"]["arguments"]) > ARCHIVE_ARGUMENTS_OVER for tc in tool_calls]
+            if "reasoning" not in m and not any(long_args):
+                continue
+            m = {k: v for k, v in m.items() if k != "reasoning"}
+            if any(long_args):
+                m["tool_calls"] = [
+                    {**tc, "function": {**tc["function"], "arguments": ARCHIVED_ARGUMENTS}} if long else tc
+                    for tc, long in zip(tool_calls, long_args)
+                ]
+        elif m["role"] == "tool":
+            content = ARCHIVED_OUTPUT
+            if isinstance(m["content"], str) and m["content"].startswith("Error"):
+                content = m["content"].split("\n", 1)[0]
+            if content == m["content"]:  # Already archived
+                continue
+            m = {**m, "content": content}
+        else:
             continue
+        replaced[i] = messages[i]
+        messages[i] = m
+
+    _archive["upto"] = end
+    _state.reset()
+    logger.debug("Archived history up to message %d", end)
+    return replaced
+
 
-        is_checkpoint = i in checkpoints
-        has_cache = isinstance(msg["content"], list) and any(b.get("cache_control") for b in msg["content"])
-
-        if has_cache and not is_checkpoint:
-            for block in msg["content"]:
-                block.pop("cache_control", None)
-        elif not has_cache and is_checkpoint:
-            if isinstance(msg["content"], str):
-                msg["content"] = [{"type": "text", "text": msg["content"], "cache_control": {"type": "ephemeral"}}]
-            elif isinstance(msg["content"], list) and msg["content"]:
-                msg["content"][-1]["cache_control"] = {"type": "ephemeral"}
+def forget_archive():
+    """Forget how far the history was archived (after undo put original messages back)."""
+    _archive.update(messages=None, upto=1)
+    _state.reset()
@@ -1,6 +1,7 @@
 """Configuration and CLI argument parsing."""
 
 import os
+import sys
 import argparse
 from dotenv import load_dotenv
 
@@ -12,19 +13,37 @@ parser.add_argument("--model", default=os.getenv("DEFAULT_MODEL", "gemini-3-pro-
 parser.add_argument("--provider", choices=["openrouter", "gemini"], default="gemini", help="LLM provider")
 parser.add_argument("--initial-prompt", help="Initial prompt to send to the agent")
 parser.add_argument("--debug", action="store_true", help="Enable debug logging")
+parser.add_argument("--llm-cache", action="store_true", help="Reuse responses to identical requests (in memory)")
 
 args, _ = parser.parse_known_args()
 
 
+def detect_family(model: str) -> str:
+    """Classify a model id as "anthropic", "openai", "gemini" or "" (other)."""
+    model = model.lower()
+    if "anthropic" in model or "claude" in model:
+        return "anthropic"
+    if any(x in model for x in ["openai", "gpt", "o1", "o3", "o4"]):
+        return "openai"
+    if "gemini" in model:
+        return "gemini"
+    return ""
+
+
 class Config:
     openrouter_api_key = os.getenv("OPENROUTER_API_KEY")
     gemini_api_key = os.getenv("GEMINI_API_KEY")
     model = args.model
+    family = detect_family(args.model)
     provider = args.provider
     mode = args.mode
     tool_output_limit = 1000
+    tool_parallelism = 8
+    llm_concurrency = 8  # Max in-flight LLM requests (shared by all providers)
     initial_prompt = args.initial_prompt
     debug = args.debug
+    show_usage = sys.stdout.isatty()  # Per-response token lines are noise in piped/headless runs
+    llm_cache = args.llm_cache
 
 
 config = Config()
@@ -1,12 +1,17 @@
 """LLM provider router."""
 
 from .config import config
-from .providers.gemini import call_gemini
-from .providers.openrouter import call_openrouter
 
 
 async def call_llm(messages: list, tools: list, model: str = None) -> dict:
-    """Route LLM calls to the configured provider."""
+    """Route LLM calls to the configured provider.
+
+    Providers are imported on first use, so startup only loads the one configured.
+    """
     if config.provider == "gemini":
+        from .providers.gemini import call_gemini
+
         return await call_gemini(messages, tools, model)
+    from .providers.openrouter import call_openrouter
+
     return await call_openrouter(messages, tools, model)
@@ -0,0 +1,112 @@
+"""HTTP plumbing shared by the providers: pooled sessions, concurrency cap and retry policy."""
+
+import asyncio
+import logging
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ..config import config
+
+logger = logging.getLogger(__name__)
+
+# Caps in-flight LLM requests across all providers, keeping bursts under RPM quotas
+request_slots = asyncio.Semaphore(config.llm_concurrency)
+
+MAX_RETRY_DELAY = 30.0  # Seconds; caps the exponential backoff and any Retry-After we wait out
+RETRY_JITTER = 0.5  # Up to +50% random spread, so throttled clients don't retry in lockstep
+RETRYABLE_STATUS = frozenset({408, 425, 429})  # Plus any 5xx; other errors won't succeed on retry
+RETRYABLE_ERROR_TYPES = frozenset({"rate_limit", "timeout", "server_error"})
+
+
+def new_session(headers: dict) -> requests.Session:
+    """Keep-alive session with a connection pool sized for concurrent requests.
+
+    Calls after the first skip the TCP/TLS handshake. Retries are handled by
+    post_with_retry, so the adapter itself never retries.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=config.llm_concurrency, max_retries=0)
+    session.mount("https://", adapter)
+    session.headers.update(headers)
+    return session
+
+
+def is_retryable(status) -> bool:
+    """Whether an HTTP status (or an API error's numeric code) is worth retrying."""
+    return isinstance(status, int) and (status in RETRYABLE_STATUS or status >= 500)
+
+
+def is_retryable_error(error) -> bool:
+    """Whether an error object returned in a response body is transient."""
+    if not isinstance(error, dict):
+        return False
+    return is_retryable(error.get("code")) or error.get("type") in RETRYABLE_ERROR_TYPES
+
+
+def retry_after(response: requests.Response) -> float:
+    """Seconds a Retry-After header asks to wait (delta-seconds or HTTP-date), 0 if absent."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return 0.0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0.0
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def retry_delay(attempt: int, response: requests.Response = None) -> float:
+    """Jittered exponential backoff; a 429's Retry-After is honored (up to MAX_RETRY_DELAY) when longer."""
+    delay = min(MAX_RETRY_DELAY, 2**attempt) * (1 + random.random() * RETRY_JITTER)
+    if response is None or response.status_code != 429:
+        return delay
+    return max(delay, min(retry_after(response), MAX_RETRY_DELAY))
+
+
+class RetryableError(Exception):
+    """Raised by a response handler for a transient failure worth another attempt."""
+
+    def __init__(self, reason: str, response: requests.Response = None):
+        super().__init__(reason)
+        self.response = response
+
+
+async def post_with_retry(send, handle, provider: str, attempts: int = 3):
+    """Send a request with the shared retry policy and return handle(data).
+
+    send is a coroutine function returning (response, data), where data is the body already
+    decoded off the event loop (only meaningful for a 200). Non-200 statuses are retried or
+    raised here; handle raises RetryableError for failures reported inside a 200 body.
+    Network errors and malformed bodies (ValueError) are retried; anything else is fatal.
+    """
+    for attempt in range(attempts):
+        try:
+            async with request_slots:
+                response, data = await send()
+            if response.status_code != 200:
+                if not is_retryable(response.status_code):
+                    raise Exception(f"{provider} API error: {response.status_code} - {response.text}")
+                raise RetryableError(str(response.status_code), response)
+            return handle(data)
+        except RetryableError as e:
+            if e.response is not None and e.response.status_code == 429:
+                wait = retry_after(e.response)
+                if wait > MAX_RETRY_DELAY:  # E.g. an exhausted daily quota: fail now rather than hang
+                    raise Exception(f"{provider} API rate limited: retry after {wait:.0f} seconds.") from None
+            logger.warning(f"Attempt {attempt + 1} failed: {e}. Retrying...")
+            await asyncio.sleep(retry_delay(attempt, e.response))
+        except (requests.exceptions.RequestException, ValueError) as e:  # ValueError: malformed JSON body
+            logger.warning(f"Attempt {attempt + 1} failed: {e}")
+            await asyncio.sleep(retry_delay(attempt))
+
+    raise Exception(f"Failed to call {provider} API after {attempts} retries.")
@@ -2,17 +2,22 @@
 
 import requests
 import json
-import time
 import asyncio
-import random
+import copy
+import hashlib
+import itertools
 import logging
-import html
+from collections import OrderedDict
 from prompt_toolkit import print_formatted_text
-from prompt_toolkit.formatted_text import HTML
+from prompt_toolkit.formatted_text import FormattedText
 from ..config import config
+from ..utils import json_dumps, json_fragment, json_loads
+from ._http import new_session, post_with_retry
 
 logger = logging.getLogger(__name__)
 
+_session = new_session({"Content-Type": "application/json"})
+
 # ---------------------------------------------------------------------------
 # Pricing (per 1M tokens)
 # ---------------------------------------------------------------------------
@@ -48,34 +53,42 @@ PRICING = {
     "gemini-2.0-flash-lite": {"input": 0.075, "output": 0.30, "cached": 0.0},
 }
 
+HIGH_TIER_PROMPT_TOKENS = 200000  # Prompts above this are billed at the high_* rates
+
+
+def pricing_tiers(rates: dict) -> tuple[tuple, tuple]:
+    """(standard, high-volume) per-token (input, output, cached) rates.
+
+    Models without a high tier use the standard rates for both.
+    """
+    standard = (rates["input"] / 1e6, rates["output"] / 1e6, rates["cached"] / 1e6)
+    if "high_input" not in rates:
+        return standard, standard
+    return standard, (rates["high_input"] / 1e6, rates["high_output"] / 1e6, rates["high_cached"] / 1e6)
+
+
+# Keyed by bare and "google/"-prefixed ids, so a known id costs one dict lookup
+PRICING_TIERS = {model: pricing_tiers(rates) for model, rates in PRICING.items()}
+PRICING_TIERS.update({f"google/{model}": tiers for model, tiers in PRICING_TIERS.items()})
+
 
 def calculate_cost(model: str, usage: dict) -> float:
     """Calculate cost from usage metadata."""
-    if not usage:
+    # No prompt count means no billable request (empty or partial usage)
+    if not usage or not usage.get("promptTokenCount"):
         return 0
 
-    model_id = model.lower().replace("google/", "")
-    pricing = PRICING.get(model_id)
-    if not pricing:
+    tiers = PRICING_TIERS.get(model) or PRICING_TIERS.get(model.lower())
+    if not tiers:
         return 0
 
     prompt = usage.get("promptTokenCount", 0)
     output = usage.get("candidatesTokenCount", 0) + usage.get("thoughtsTokenCount", 0)
     cached = usage.get("cachedContentTokenCount", 0)
 
-    # Use high-volume pricing if > 200k tokens
-    if prompt > 200000 and "high_input" in pricing:
-        return (
-            ((prompt - cached) / 1e6) * pricing["high_input"]
-            + (output / 1e6) * pricing["high_output"]
-            + (cached / 1e6) * pricing["high_cached"]
-        )
-
-    return (
-        ((prompt - cached) / 1e6) * pricing["input"]
-        + (output / 1e6) * pricing["output"]
-        + (cached / 1e6) * pricing["cached"]
-    )
+    # High-volume pricing applies above the prompt-size threshold
+    input_rate, output_rate, cached_rate = tiers[prompt > HIGH_TIER_PROMPT_TOKENS]
+    return (prompt - cached) * input_rate + output * output_rate + cached * cached_rate
 
 
 # ---------------------------------------------------------------------------
@@ -83,13 +96,18 @@ def calculate_cost(model: str, usage: dict) -> float:
 # ---------------------------------------------------------------------------
 
 
+# JSON Schema type names and their Gemini (uppercase) spellings
+TYPE_MAP = {t: t.upper() for t in ("string", "number", "integer", "boolean", "object", "array", "null")}
+SCHEMA_KEYS = frozenset({"type", "properties", "items"})  # Keys that need converting
+
+
 def to_gemini_schema(schema: dict) -> dict:
     """Convert OpenAI schema types to Gemini (uppercase)."""
-    if not schema or not isinstance(schema, dict):
+    if not schema or not isinstance(schema, dict) or SCHEMA_KEYS.isdisjoint(schema):
         return schema
     result = schema.copy()
     if "type" in result and isinstance(result["type"], str):
-        result["type"] = result["type"].upper()
+        result["type"] = TYPE_MAP.get(result["type"]) or result["type"].upper()
     if "properties" in result:
         result["properties"] = {k: to_gemini_schema(v) for k, v in result["properties"].items()}
     if "items" in result:
@@ -97,175 +115,321 @@ def to_gemini_schema(schema: dict) -> dict:
     return result
 
 
+def text_part(item: dict) -> dict:
+    return {"text": item["text"]}
+
+
+def image_part(item: dict) -> dict | None:
+    """Inline data part for a base64 data URL (other URLs are dropped)."""
+    url = item["image_url"]["url"]
+    if not url.startswith("data:image/"):
+        return None
+    # data:<mime>;base64,<data> -- slice instead of splitting the (large) payload
+    semi = url.find(";")
+    comma = url.find(",", semi)
+    if semi == -1 or comma == -1:
+        return None
+    return {"inline_data": {"mime_type": url[5:semi], "data": url[comma + 1 :]}}
+
+
+PART_CONVERTERS = {"text": text_part, "image_url": image_part}
+
+
 def to_gemini_parts(content) -> list:
     """Convert OpenAI content format to Gemini parts."""
     if not content:
         return []
-    if isinstance(content, str):
+    # Message content is built from plain JSON types, so exact type checks suffice
+    kind = type(content)
+    if kind is str:
         return [{"text": content}]
-    if isinstance(content, list):
+    if kind is list:
         parts = []
         for item in content:
-            if isinstance(item, str):
+            kind = type(item)
+            if kind is str:
                 parts.append({"text": item})
-            elif isinstance(item, dict):
-                if item.get("type") == "text":
-                    parts.append({"text": item["text"]})
-                elif item.get("type") == "image_url":
-                    url = item["image_url"]["url"]
-                    if url.startswith("data:image/"):
-                        mime, data = url.split(";")[0].split(":")[1], url.split(",")[1]
-                        parts.append({"inline_data": {"mime_type": mime, "data": data}})
+            elif kind is dict:
+                convert = PART_CONVERTERS.get(item.get("type"))
+                part = convert(item) if convert else None
+                if part:
+                    parts.append(part)
         return parts
     return []
 
 
-def to_gemini_messages(messages: list) -> tuple[list, dict | None]:
-    """Convert OpenAI messages to Gemini format. Returns (contents, system_instruction)."""
-    contents = []
-    system_instruction = None
+def to_gemini_content(msg: dict) -> dict | None:
+    """Convert one non-system OpenAI message to a Gemini content (None if it has no parts)."""
+    if msg["role"] == "user":
+        return {"role": "user", "parts": to_gemini_parts(msg["content"])}
+    if msg["role"] == "assistant":
+        parts = to_gemini_parts(msg.get("content"))
+        for tc in msg.get("tool_calls") or []:
+            part = {"functionCall": {"name": tc["function"]["name"], "args": json_loads(tc["function"]["arguments"])}}
+            if "thought_signature" in tc["function"]:
+                part["thoughtSignature"] = tc["function"]["thought_signature"]
+            parts.append(part)
+        return {"role": "model", "parts": parts} if parts else None
+    if msg["role"] == "tool":
+        return {"role": "user", "parts": [to_function_response(msg)]}
+    return None
+
+
+def to_function_response(msg: dict) -> dict:
+    return {"functionResponse": {"name": msg["name"], "response": {"result": msg["content"]}}}
+
+
+class GeminiContentBuilder:
+    """Converted Gemini contents for a message history, kept in step with it between calls."""
 
-    for msg in messages:
+    def __init__(self):
+        self.sources = []  # Messages converted so far, in history order
+        self.ends = []  # len(contents) after each source, to cut contents back on a rewrite
+        self.contents = []
+        self.system_instruction = None
+
+    def append(self, msg: dict):
         if msg["role"] == "system":
-            system_instruction = {"parts": to_gemini_parts(msg["content"])}
-        elif msg["role"] == "user":
-            contents.append({"role": "user", "parts": to_gemini_parts(msg["content"])})
-        elif msg["role"] == "assistant":
-            parts = to_gemini_parts(msg.get("content"))
-            for tc in msg.get("tool_calls") or []:
-                part = {
-                    "functionCall": {"name": tc["function"]["name"], "args": json.loads(tc["function"]["arguments"])}
-                }
-                if "thought_signature" in tc["function"]:
-                    part["thoughtSignature"] = tc["function"]["thought_signature"]
-                parts.append(part)
-            if parts:
-                contents.append({"role": "model", "parts": parts})
-        elif msg["role"] == "tool":
-            contents.append(
-                {
-                    "role": "function",
-                    "parts": [{"functionResponse": {"name": msg["name"], "response": {"result": msg["content"]}}}],
-                }
-            )
+            self.system_instruction = {"parts": to_gemini_parts(msg["content"])}
+        elif msg["role"] == "tool" and self.sources and self.sources[-1]["role"] == "tool":
+            # Results of one batch of calls share a single content
+            self.contents[-1]["parts"].append(to_function_response(msg))
+        else:
+            content = to_gemini_content(msg)
+            if content:
+                self.contents.append(content)
+        self.sources.append(msg)
+        self.ends.append(len(self.contents))
+
+    def sync(self, messages: list) -> list:
+        """Convert only messages that are new or were replaced since the last call."""
+        # Messages are replaced, never mutated, so identity tells what is still valid
+        keep = 0
+        for old, new in zip(self.sources, messages):
+            if old is not new:
+                break
+            keep += 1
+        if keep < len(self.sources):
+            # A shared tool-result content can't be cut partway; rebuild its whole run
+            while keep and self.sources[keep - 1]["role"] == "tool":
+                keep -= 1
+            del self.sources[keep:]
+            del self.contents[self.ends[keep - 1] if keep else 0 :]
+            del self.ends[keep:]
+            if not keep:
+                self.system_instruction = None
+        for msg in messages[keep:]:
+            self.append(msg)
+        return self.contents
+
+
+_builder = GeminiContentBuilder()
+_history = None  # The list _builder follows: the first one converted, i.e. the agent's history
 
-    return contents, system_instruction
+
+def to_gemini_messages(messages: list) -> tuple[list, dict | None]:
+    """Convert OpenAI messages to Gemini format. Returns (contents, system_instruction).
+
+    The conversation history is converted incrementally by a shared builder; one-off lists
+    (google_search, describe_image) get a builder of their own, so they neither disturb
+    it nor see its later changes. The returned objects may be shared; don't mutate them.
+    """
+    global _history
+    if _history is None:
+        _history = messages
+    builder = _builder if messages is _history else GeminiContentBuilder()
+    return builder.sync(messages), builder.system_instruction
+
+
+_tools_cache = {"source": None, "converted": [], "names": frozenset()}  # The agent passes the same list every turn
+
+
+def cached_tools(tools: list) -> dict:
+    """Cache entry for a tools list: Gemini declarations and the set of tool names."""
+    if tools is not _tools_cache["source"]:
+        converted = [
+            {
+                "function_declarations": [
+                    {
+                        "name": t["function"]["name"],
+                        "description": t["function"]["description"],
+                        "parameters": to_gemini_schema(t["function"]["parameters"]),
+                    }
+                    for t in tools
+                ]
+            }
+        ]
+        names = frozenset(t["function"]["name"] for t in tools)
+        _tools_cache.update(source=tools, converted=converted, names=names)
+    return _tools_cache
+
+
+def has_search_trigger(tools: list) -> bool:
+    """Whether a tools list carries the Google Search trigger, without caching the list.
+
+    The cache has one slot; filling it with google_search's trigger list would evict the
+    agent's tools and force their reconversion on the next turn.
+    """
+    if tools is _tools_cache["source"]:
+        return "__google_search_trigger__" in _tools_cache["names"]
+    return any(t["function"]["name"] == "__google_search_trigger__" for t in tools)
 
 
 def to_gemini_tools(tools: list) -> list:
-    """Convert OpenAI tools format to Gemini."""
+    """Convert OpenAI tools format to Gemini (the result is cached per tools list; don't mutate it)."""
     if not tools:
         return []
-    return [
-        {
-            "function_declarations": [
-                {
-                    "name": t["function"]["name"],
-                    "description": t["function"]["description"],
-                    "parameters": to_gemini_schema(t["function"]["parameters"]),
-                }
-                for t in tools
-            ]
-        }
-    ]
+    return cached_tools(tools)["converted"]
 
 
 # ---------------------------------------------------------------------------
 # API Call
 # ---------------------------------------------------------------------------
 
+GROUNDING_TOOLS = [{"googleSearch": {}}]
+_call_ids = itertools.count()  # Gemini returns no call ids; these only need to be unique per session
+
+# Opt-in (--llm-cache) LRU of responses keyed by model and request bytes; temperature is 0
+RESPONSE_CACHE_SIZE = 64
+_responses = OrderedDict()
+
+
+def cached_response(key: bytes) -> dict | None:
+    """A copy of a cached response with fresh call ids and empty usage (nothing was billed)."""
+    if key not in _responses:
+        return None
+    _responses.move_to_end(key)
+    message = copy.deepcopy(_responses[key])
+    for tc in message["tool_calls"] or []:
+        tc["id"] = f"call_{next(_call_ids):x}"
+    return {"message": message, "usage": {}}
+
+
+def cache_response(key: bytes, message: dict):
+    _responses[key] = copy.deepcopy(message)
+    if len(_responses) > RESPONSE_CACHE_SIZE:
+        _responses.popitem(last=False)
+
+
+def encode_body(body: dict, contents: str, tools: list, system_instruction: dict | None) -> bytes:
+    """Serialize a request body, splicing in its encoded contents and cached invariant parts."""
+    payload = f'{json_dumps(body)[:-1]},"contents":{contents},"tools":{json_fragment(tools)}'
+    if system_instruction:
+        payload += f',"systemInstruction":{json_fragment(system_instruction)}'
+    return (payload + "}").encode()
+
+
+def post_stream(url: str, payload: bytes) -> tuple[requests.Response, list]:
+    """POST a streaming request and collect its SSE events (blocking; run in a thread).
+
+    Events are only read for a 200 response; otherwise the body stays readable via .text.
+    """
+    response = _session.post(url, data=payload, stream=True, timeout=120)
+    if response.status_code != 200:
+        return response, []
+    with response:
+        return response, [json_loads(line[5:]) for line in response.iter_lines() if line.startswith(b"data:")]
+
 
 async def call_gemini(messages: list, tools: list, model: str = None) -> dict:
     """Call Gemini API. Returns dict with 'message' and 'usage'."""
     model_id = (model or config.model).replace("google/", "")
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_id}:generateContent?key={config.gemini_api_key}"
+    # Streamed: the 120s timeout then bounds gaps between chunks, not a whole long generation
+    url = (
+        f"https://generativelanguage.googleapis.com/v1beta/models/{model_id}:streamGenerateContent"
+        f"?alt=sse&key={config.gemini_api_key}"
+    )
 
     contents, system_instruction = to_gemini_messages(messages)
 
     # Check for google search trigger
-    use_grounding = any(t["function"]["name"] == "__google_search_trigger__" for t in tools) if tools else False
+    use_grounding = bool(tools) and has_search_trigger(tools)
 
-    body = {
-        "contents": contents,
-        "tools": [{"googleSearch": {}}] if use_grounding else to_gemini_tools(tools),
-        "generationConfig": {"temperature": 0.0},
-    }
+    gemini_tools = GROUNDING_TOOLS if use_grounding else to_gemini_tools(tools)
+    # Encoded now, before any await: the builder may change the shared contents meanwhile
+    contents_json = json_dumps(contents)
+    body = {"generationConfig": {"temperature": 0.0}}
 
     # Enable thinking for pro models
     if "pro" in model_id.lower():
         body["generationConfig"]["thinkingConfig"] = {"includeThoughts": True}
         body["generationConfig"]["maxOutputTokens"] = 64000
 
-    if system_instruction:
-        body["systemInstruction"] = system_instruction
-
-    # Retry loop
-    for attempt in range(3):
-        try:
-            response = await asyncio.to_thread(
-                requests.post, url, headers={"Content-Type": "application/json"}, json=body, timeout=120
+    # Serialize once; retries resend the same bytes. Tools and system instruction are the
+    # same objects every turn, so only contents and generationConfig are encoded per call.
+    payload = encode_body(body, contents_json, gemini_tools, system_instruction)
+
+    if config.llm_cache:
+        cache_key = hashlib.blake2b(model_id.encode() + b"\0" + payload, digest_size=16).digest()
+        hit = cached_response(cache_key)
+        if hit:
+            logger.debug("Response cache hit")
+            return hit
+
+    async def send() -> tuple[requests.Response, list]:
+        nonlocal payload
+        response, events = await asyncio.to_thread(post_stream, url, payload)
+
+        # Handle thinkingConfig not supported
+        if response.status_code == 400 and "thinkingConfig" in response.text:
+            logger.warning("Model doesn't support thinkingConfig, retrying without it.")
+            body["generationConfig"].pop("thinkingConfig", None)
+            payload = encode_body(body, contents_json, gemini_tools, system_instruction)
+            response, events = await asyncio.to_thread(post_stream, url, payload)
+        return response, events
+
+    def handle(events: list) -> dict:
+        # Process usage (every event carries the running totals; the last one is final)
+        usage = next((e["usageMetadata"] for e in reversed(events) if "usageMetadata" in e), {})
+        if usage:
+            if config.show_usage and logger.isEnabledFor(logging.INFO):
+                print_formatted_text(FormattedText([("#666666", f"Tokens: {json_dumps(usage)}")]))
+            usage["cost"] = calculate_cost(model_id, usage)
+            # Derived totals, so consumers can read the cache-hit split without re-deriving it
+            prompt, cached = usage.get("promptTokenCount", 0), usage.get("cachedContentTokenCount", 0)
+            usage["cached_input"] = cached
+            usage["uncached_input"] = prompt - cached
+            usage["output_including_thoughts"] = usage.get("candidatesTokenCount", 0) + usage.get(
+                "thoughtsTokenCount", 0
             )
+            usage["tier"] = "high" if prompt > HIGH_TIER_PROMPT_TOKENS else "std"
+
+        candidates = [e["candidates"][0] for e in events if e.get("candidates")]
+        if not candidates:
+            feedback = next((e["promptFeedback"] for e in events if "promptFeedback" in e), events)
+            raise Exception(f"No candidates: {json.dumps(feedback)}")
+
+        # Parse response: text and thoughts arrive as fragments spread over the events
+        parts = [part for c in candidates for part in c.get("content", {}).get("parts", [])]
+        content_chunks, reasoning_chunks, tool_calls = [], [], []
+
+        for part in parts:
+            thought = part.get("thought")
+            if thought:
+                reasoning_chunks.append(part.get("text", "") if isinstance(thought, bool) else thought)
+            elif "text" in part:
+                content_chunks.append(part["text"])
+            if "functionCall" in part:
+                tc = {
+                    "id": f"call_{next(_call_ids):x}",
+                    "type": "function",
+                    "function": {
+                        "name": part["functionCall"]["name"],
+                        "arguments": json_dumps(part["functionCall"]["args"]),
+                    },
+                }
+                if "thoughtSignature" in part:
+                    tc["function"]["thought_signature"] = part["thoughtSignature"]
+                tool_calls.append(tc)
+
+        message = {
+            "role": "assistant",
+            "content": "".join(content_chunks),
+            "reasoning": "".join(reasoning_chunks).strip() or None,
+            "tool_calls": tool_calls or None,
+        }
+        if config.llm_cache:
+            cache_response(cache_key, message)
+        return {"message": message, "usage": usage}
 
-            # Handle thinkingConfig not supported
-            if response.status_code == 400 and "thinkingConfig" in response.text:
-                logger.warning("Model doesn't support thinkingConfig, retrying without it.")
-                body["generationConfig"].pop("thinkingConfig", None)
-                response = await asyncio.to_thread(
-                    requests.post, url, headers={"Content-Type": "application/json"}, json=body, timeout=120
-                )
-
-            if response.status_code != 200:
-                if response.status_code >= 500 or response.status_code == 429:
-                    logger.warning(f"Attempt {attempt + 1} failed: {response.status_code}. Retrying...")
-                    await asyncio.sleep(2**attempt)
-                    continue
-                raise Exception(f"Gemini API error: {response.status_code} - {response.text}")
-
-            data = response.json()
-
-            # Process usage
-            usage = data.get("usageMetadata", {})
-            if usage:
-                print_formatted_text(HTML(f"<style fg='#666666'>Tokens: {html.escape(json.dumps(usage))}</style>"))
-                usage["cost"] = calculate_cost(model_id, usage)
-
-            if "candidates" not in data or not data["candidates"]:
-                raise Exception(f"No candidates: {json.dumps(data.get('promptFeedback', data))}")
-
-            # Parse response
-            parts = data["candidates"][0].get("content", {}).get("parts", [])
-            content, reasoning, tool_calls = "", "", []
-
-            for part in parts:
-                if part.get("thought"):
-                    reasoning += (part.get("text", "") if isinstance(part["thought"], bool) else part["thought"]) + "\n"
-                elif "text" in part:
-                    content += part["text"]
-                if "functionCall" in part:
-                    tc = {
-                        "id": f"call_{int(time.time())}_{random.randint(1000, 9999)}",
-                        "type": "function",
-                        "function": {
-                            "name": part["functionCall"]["name"],
-                            "arguments": json.dumps(part["functionCall"]["args"]),
-                        },
-                    }
-                    if "thoughtSignature" in part:
-                        tc["function"]["thought_signature"] = part["thoughtSignature"]
-                    tool_calls.append(tc)
-
-            return {
-                "message": {
-                    "role": "assistant",
-                    "content": content,
-                    "reasoning": reasoning.strip() or None,
-                    "tool_calls": tool_calls or None,
-                },
-                "usage": usage,
-            }
-
-        except requests.exceptions.RequestException as e:
-            logger.warning(f"Attempt {attempt + 1} failed: {e}")
-            await asyncio.sleep(2**attempt)
-
-    raise Exception("Failed to call Gemini API after 3 retries.")
+    return await post_with_retry(send, handle, "Gemini")
@@ -1,143 +1,219 @@
 """OpenRouter API provider."""
 
 import requests
-import json
 import asyncio
+import functools
 import logging
-import html
 from prompt_toolkit import print_formatted_text
-from prompt_toolkit.formatted_text import HTML
-from ..config import config
+from prompt_toolkit.formatted_text import FormattedText
+from ..config import config, detect_family
 from ..cache import apply_anthropic_cache
+from ..utils import json_dumps, json_fragment, json_loads
+from ._http import RetryableError, is_retryable_error, new_session, post_with_retry
 
 logger = logging.getLogger(__name__)
 
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
 
-def prepare_messages_for_openrouter(messages: list, model: str) -> list:
-    """Prepare messages for OpenRouter, including reasoning preservation for Gemini."""
-    is_gemini = "gemini" in model.lower()
-    prepared = []
+# One session for the process: keep-alive reuses the TCP/TLS connection across calls
+_session = new_session(
+    {
+        "Authorization": f"Bearer {config.openrouter_api_key}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": "https://github.com/sonercirit/agent",
+        "X-Title": "Agent",
+    }
+)
 
-    for msg in messages:
-        new_msg = {"role": msg["role"]}
 
-        # Handle content
-        if "content" in msg:
-            new_msg["content"] = msg["content"]
+# Message keys OpenRouter accepts. Gemini models also need reasoning_details: it carries
+# the encrypted thought signatures required for multi-turn tool calls.
+MESSAGE_KEYS = ("role", "content", "tool_calls", "tool_call_id", "name")
+GEMINI_MESSAGE_KEYS = MESSAGE_KEYS + ("reasoning_details",)
 
-        # Handle tool calls (assistant messages)
-        if "tool_calls" in msg:
-            new_msg["tool_calls"] = msg["tool_calls"]
 
-        # Handle tool results
-        if "tool_call_id" in msg:
-            new_msg["tool_call_id"] = msg["tool_call_id"]
-        if "name" in msg:
-            new_msg["name"] = msg["name"]
+def prepare_messages_for_openrouter(messages: list, is_gemini: bool) -> list:
+    """Prepare messages for OpenRouter, including reasoning preservation for Gemini."""
+    keys = GEMINI_MESSAGE_KEYS if is_gemini else MESSAGE_KEYS
+    return [{k: msg[k] for k in keys if k in msg} for msg in messages]
 
-        # Preserve reasoning_details for Gemini models (required for tool calling)
-        # This contains the encrypted thought signatures needed for multi-turn tool calls
-        if is_gemini and "reasoning_details" in msg:
-            new_msg["reasoning_details"] = msg["reasoning_details"]
 
-        prepared.append(new_msg)
+def post(payload: bytes) -> tuple[requests.Response, dict | None]:
+    """POST a completion request and decode its body (blocking; run in a thread)."""
+    response = _session.post(OPENROUTER_URL, data=payload, timeout=120)
+    return response, json_loads(response.content) if response.status_code == 200 else None
 
-    return prepared
 
+def post_stream(payload: bytes) -> tuple[requests.Response, dict | None]:
+    """POST a streaming request and assemble its SSE chunks (blocking; run in a thread)."""
+    response = _session.post(OPENROUTER_URL, data=payload, stream=True, timeout=120)
+    if response.status_code != 200:
+        return response, None
+    events = []
+    with response:
+        for line in response.iter_lines():
+            if not line.startswith(b"data:"):  # Blank separators and ": PROCESSING" keep-alives
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                break
+            events.append(json_loads(data))
+    return response, merge_stream(events)
+
+
+def merge_stream(events: list) -> dict:
+    """Assemble streamed chunks into the shape of a non-streamed completion."""
+    content, reasoning, tool_calls, usage, seen_choice = [], [], {}, {}, False
+    for event in events:
+        if "error" in event:
+            return {"error": event["error"]}
+        usage = event.get("usage") or usage
+        for choice in event.get("choices") or []:
+            seen_choice = True
+            delta = choice.get("delta") or {}
+            if delta.get("content"):
+                content.append(delta["content"])
+            if delta.get("reasoning"):
+                reasoning.append(delta["reasoning"])
+            # Tool calls arrive as fragments keyed by index: id and name first, then arguments
+            for fragment in delta.get("tool_calls") or []:
+                index = fragment.get("index", 0)
+                if index not in tool_calls:
+                    tool_calls[index] = {"id": None, "type": "function", "function": {"name": "", "arguments": ""}}
+                tc = tool_calls[index]
+                if fragment.get("id"):
+                    tc["id"] = fragment["id"]
+                function = fragment.get("function") or {}
+                tc["function"]["name"] += function.get("name") or ""
+                tc["function"]["arguments"] += function.get("arguments") or ""
+    if not seen_choice:
+        return {"usage": usage}
+    message = {
+        "role": "assistant",
+        "content": "".join(content),
+        "reasoning": "".join(reasoning) or None,
+        "tool_calls": [tool_calls[i] for i in sorted(tool_calls)] or None,
+    }
+    return {"choices": [{"message": message}], "usage": usage}
 
-async def call_openrouter(messages: list, tools: list, model: str = None) -> dict:
-    """Call OpenRouter API. Returns dict with 'message' and 'usage'."""
-    effective_model = model or config.model
 
-    # Detect provider type for optimizations
-    is_anthropic = "anthropic" in effective_model or "claude" in effective_model
-    is_openai = any(x in effective_model for x in ["openai", "gpt", "o1", "o3", "o4"])
-    is_gemini = "gemini" in effective_model
+def format_usage(usage: dict) -> str:
+    """One-line token summary from the usage fields that matter."""
+    cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+    return (
+        f"Tokens: {usage.get('prompt_tokens', 0)} in ({cached} cached), "
+        f"{usage.get('completion_tokens', 0)} out, {usage.get('total_tokens', 0)} total"
+    )
 
-    # Apply Anthropic caching if applicable
-    if is_anthropic:
-        apply_anthropic_cache(messages, effective_model)
 
-    # Prepare messages (handles reasoning preservation for Gemini)
-    prepared_messages = prepare_messages_for_openrouter(messages, effective_model)
+@functools.lru_cache(maxsize=16)
+def model_family(model: str) -> str:
+    """Family of a model id, resolved once per id."""
+    return config.family if model == config.model else detect_family(model)
 
-    headers = {
-        "Authorization": f"Bearer {config.openrouter_api_key}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "https://github.com/sonercirit/agent",
-        "X-Title": "Agent",
-    }
 
-    body = {
-        "model": effective_model,
-        "messages": prepared_messages,
-        "tools": tools if tools else None,
+# Providers each family is pinned to (no fallbacks to other hosts)
+PROVIDER_ORDER = {"anthropic": "Anthropic", "openai": "OpenAI", "gemini": "Google AI Studio"}
+
+
+@functools.lru_cache(maxsize=16)
+def body_template(model: str) -> dict:
+    """Request fields that depend only on the model (shared: copy, never mutate)."""
+    family = model_family(model)
+    provider = {"allow_fallbacks": False}
+    if family in PROVIDER_ORDER:
+        provider = {"order": [PROVIDER_ORDER[family]], "allow_fallbacks": False}
+    template = {
+        "model": model,
         "temperature": 0,
         "usage": {"include": True},
         "include_reasoning": True,
         "reasoning": {"effort": "high"},
-        "provider": {"allow_fallbacks": False},
+        "provider": provider,
     }
+    # Stream, so the timeout bounds gaps between chunks rather than a whole long generation.
+    # Gemini's reasoning_details carry thought signatures that must round-trip exactly; they
+    # arrive whole in a plain response, so Gemini models keep the non-streamed path.
+    if family != "gemini":
+        template["stream"] = True
+    return template
+
+
+_tools_cache = {"source": None, "tools": None, "online": False}  # The agent passes the same list every turn
+
+
+def split_tools(tools: list) -> tuple[list | None, bool]:
+    """(tools to send, whether the Google Search trigger was present), cached per list.
 
-    # Remove None values
-    body = {k: v for k, v in body.items() if v is not None}
+    One pass partitions out the trigger; the returned list keeps its identity across
+    calls, so its encoded JSON is cached too.
+    """
+    if tools is not _tools_cache["source"]:
+        kept, online = [], False
+        for t in tools:
+            if t["function"]["name"] == "__google_search_trigger__":
+                online = True
+            else:
+                kept.append(t)
+        _tools_cache.update(source=tools, tools=(kept if online else tools) or None, online=online)
+    return _tools_cache["tools"], _tools_cache["online"]
+
+
+async def call_openrouter(messages: list, tools: list, model: str = None) -> dict:
+    """Call OpenRouter API. Returns dict with 'message' and 'usage'."""
+    effective_model = model or config.model
 
-    # Lock to specific providers
+    # Detect provider type for optimizations
+    family = model_family(effective_model)
+    is_anthropic = family == "anthropic"
+    is_gemini = family == "gemini"
+
+    # Apply Anthropic caching if applicable
     if is_anthropic:
-        body["provider"] = {"order": ["Anthropic"], "allow_fallbacks": False}
-    elif is_openai:
-        body["provider"] = {"order": ["OpenAI"], "allow_fallbacks": False}
-    elif is_gemini:
-        body["provider"] = {"order": ["Google AI Studio"], "allow_fallbacks": False}
+        apply_anthropic_cache(messages, len(json_fragment(tools)) if tools else 0)
+
+    # Prepare messages (handles reasoning preservation for Gemini)
+    prepared_messages = prepare_messages_for_openrouter(messages, is_gemini)
+
+    # Fields fixed per model come from a cached template; only per-call fields are added
+    body = {**body_template(effective_model), "messages": prepared_messages}
+    stream = body.get("stream", False)
+    body_tools, online = split_tools(tools) if tools else (None, False)
 
     # Handle Google Search trigger
-    if tools and any(t["function"]["name"] == "__google_search_trigger__" for t in tools):
-        if not body["model"].endswith(":online"):
-            body["model"] += ":online"
-        body["tools"] = [t for t in tools if t["function"]["name"] != "__google_search_trigger__"]
-        if not body["tools"]:
-            body.pop("tools", None)
-
-    # Retry loop
-    for attempt in range(3):
-        try:
-            response = await asyncio.to_thread(
-                requests.post, "https://openrouter.ai/api/v1/chat/completions", headers=headers, json=body, timeout=120
-            )
-
-            if response.status_code != 200:
-                if response.status_code >= 500 or response.status_code == 429:
-                    logger.warning(f"Attempt {attempt + 1} failed: {response.status_code}. Retrying...")
-                    await asyncio.sleep(2**attempt)
-                    continue
-                raise Exception(f"OpenRouter API error: {response.status_code} - {response.text}")
-
-            data = response.json()
-
-            if "error" in data:
-                logger.warning(f"API error: {data['error']}. Retrying...")
-                await asyncio.sleep(2**attempt)
-                continue
+    if online and not body["model"].endswith(":online"):
+        body["model"] += ":online"
 
-            if "choices" not in data or not data["choices"]:
-                logger.warning("No choices in response. Retrying...")
-                await asyncio.sleep(2**attempt)
-                continue
+    # Serialize once; retries resend the same bytes. The tool schemas are the same list
+    # every turn, so their cached encoding is spliced in rather than re-encoded.
+    payload = json_dumps(body)
+    if body_tools is not None:
+        payload = f'{payload[:-1]},"tools":{json_fragment(body_tools)}}}'
+    payload = payload.encode()
+
+    async def send():
+        return await asyncio.to_thread(post_stream if stream else post, payload)
+
+    def handle(data: dict) -> dict:
+        if "error" in data:
+            # Bad requests, auth failures and context overflows fail the same way every time
+            if not is_retryable_error(data["error"]):
+                raise Exception(f"OpenRouter API error: {data['error']}")
+            raise RetryableError(f"API error: {data['error']}")
 
-            usage = data.get("usage", {})
-            if usage:
-                print_formatted_text(HTML(f"<style fg='#666666'>Tokens: {html.escape(json.dumps(usage))}</style>"))
+        if "choices" not in data or not data["choices"]:
+            raise RetryableError("No choices in response")
 
-            msg = data["choices"][0]["message"]
+        usage = data.get("usage", {})
+        if usage and config.show_usage and logger.isEnabledFor(logging.INFO):
+            print_formatted_text(FormattedText([("#666666", format_usage(usage))]))
 
-            # Log reasoning details preservation for debugging
-            if is_gemini and msg.get("reasoning_details"):
-                logger.debug(f"Response has reasoning_details: {len(msg['reasoning_details'])} items")
+        msg = data["choices"][0]["message"]
 
-            return {"message": msg, "usage": usage}
+        # Log reasoning details preservation for debugging
+        if is_gemini and msg.get("reasoning_details"):
+            logger.debug("Response has reasoning_details: %d items", len(msg["reasoning_details"]))
 
-        except requests.exceptions.RequestException as e:
-            logger.warning(f"Attempt {attempt + 1} failed: {e}")
-            await asyncio.sleep(2**attempt)
+        return {"message": msg, "usage": usage}
 
-    raise Exception("Failed to call OpenRouter API after 3 retries.")
+    return await post_with_retry(send, handle, "OpenRouter")
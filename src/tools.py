@@ -1,41 +1,69 @@
 """Tool implementations and schemas for the agent."""
 
-import subprocess
+import asyncio
+import contextlib
+import itertools
 import os
+import sys
 import time
 import random
-import base64
-from .utils import truncate_output
+import tempfile
+import mmap
+from .utils import truncate_output, write_in_dir
+
+try:
+    import pybase64 as base64  # SIMD-accelerated drop-in, used when installed
+except ImportError:
+    import base64
 
 # ---------------------------------------------------------------------------
 # Tool Implementations
 # ---------------------------------------------------------------------------
 
 
-async def bash(command: str) -> str:
-    """Execute a bash command with timeout."""
+PIPE = asyncio.subprocess.PIPE
+
+
+async def run_process(spawn) -> str:
+    """Await a create_subprocess_* coroutine (with piped output) and collect its output, with timeout."""
     try:
-        proc = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=30)
-        output = proc.stdout + (f"\nSTDERR:\n{proc.stderr}" if proc.stderr else "")
+        # Non-blocking: other tools and the UI keep running while the command does
+        proc = await spawn
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=30)
+        finally:
+            if proc.returncode is None:  # Timed out or cancelled: don't leave it running
+                proc.kill()
+                await proc.wait()
+        stdout, stderr = stdout.decode(errors="replace"), stderr.decode(errors="replace")
+        output = stdout + (f"\nSTDERR:\n{stderr}" if stderr else "")
         return truncate_output(output) if output.strip() else "(Command executed successfully with no output)"
-    except subprocess.TimeoutExpired:
+    except asyncio.TimeoutError:
         return "Error: Command timed out after 30 seconds."
     except Exception as e:
         return f"Error executing command: {e}"
 
 
+async def bash(command: str) -> str:
+    """Execute a bash command with timeout."""
+    return await run_process(asyncio.create_subprocess_shell(command, stdout=PIPE, stderr=PIPE))
+
+
 async def search_files(pattern: str) -> str:
     """Search for files by name pattern using fd."""
     if not pattern:
         return "Error: 'pattern' is required."
-    return await bash(f'fd "{pattern}"')
+    # Exec directly: no shell to fork, and the pattern reaches fd verbatim
+    return await run_process(asyncio.create_subprocess_exec("fd", pattern, stdout=PIPE, stderr=PIPE))
 
 
 async def search_string(query: str) -> str:
     """Search for a string in files using ripgrep."""
     if not query:
         return "Error: 'query' is required."
-    return await bash(f'rg -n -C 5 -- "{query}" .')
+    return await run_process(
+        asyncio.create_subprocess_exec("rg", "-n", "-C", "5", "--", query, ".", stdout=PIPE, stderr=PIPE)
+    )
 
 
 async def read_file(path: str, start_line: int = None, end_line: int = None) -> str:
@@ -43,59 +71,174 @@ async def read_file(path: str, start_line: int = None, end_line: int = None) ->
     if not path:
         return "Error: 'path' is required."
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-
         start = max(0, (start_line or 1) - 1)
-        end = min(len(lines), end_line or len(lines))
+        # Limit to 500 lines max; end_line < 1 (models send -1 for "to EOF") means no end
+        end = min(end_line if end_line and end_line > 0 else start + 500, start + 500)
 
-        # Limit to 500 lines max
-        if end - start > 500:
-            end = start + 500
+        # Only the requested range is kept in memory; the rest is just counted
+        with open(path, "r", encoding="utf-8") as f:
+            skipped = sum(1 for _ in itertools.islice(f, start))
+            lines = list(itertools.islice(f, max(0, end - start)))
+            total = skipped + len(lines) + sum(1 for _ in f)
 
-        return truncate_output(f"(Total lines: {len(lines)})\n" + "".join(lines[start:end]))
+        return truncate_output(f"(Total lines: {total})\n" + "".join(lines))
     except Exception as e:
         return f"Error reading file: {e}"
 
 
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+@contextlib.contextmanager
+def atomic_output(path: str):
+    """Unbuffered binary file that replaces path on success, so a crash never leaves it half-written.
+
+    An existing file keeps its permissions; symlinks are written through, not replaced.
+    """
+    path = os.path.realpath(path)
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = 0o666 & ~_UMASK
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.")
+    try:
+        with os.fdopen(fd, "wb", buffering=0) as f:
+            yield f
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def write_atomic(path: str, data: str):
+    """Write a file atomically (see atomic_output)."""
+    with atomic_output(path) as f:
+        f.write(data.encode("utf-8"))
+
+
+def copy_range(src: int, out, start: int, end: int, mm: mmap.mmap):
+    """Copy bytes [start, end) of the file open as src into out, in the kernel where supported."""
+    while start < end:
+        try:
+            sent = os.sendfile(out.fileno(), src, start, end - start)
+        except OSError:  # No file-to-file sendfile (e.g. macOS): copy from the map
+            sent = out.write(mm[start:end])
+        if not sent:
+            raise OSError(f"Short copy at offset {start}")
+        start += sent
+
+
+def replace_in_file(path: str, old: str, new: str) -> bool:
+    """Replace every occurrence of old with new in path; False (file untouched) if absent.
+
+    The lookup is a byte search over a memory map, so a miss costs no read or decode,
+    and the unchanged spans are copied by sendfile without passing through Python.
+    Files with CR line endings take the text path, whose newline translation lets
+    LF-only old text match (and normalizes the file to LF, as before).
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:  # Empty files can't be mapped
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm.find(b"\r") == -1:
+                old_bytes, new_bytes = old.encode("utf-8"), new.encode("utf-8")
+                pos = mm.find(old_bytes)
+                if pos == -1:
+                    return False
+                with atomic_output(path) as out:
+                    offset = 0
+                    while pos != -1:
+                        copy_range(f.fileno(), out, offset, pos, mm)
+                        out.write(new_bytes)
+                        offset = pos + len(old_bytes)
+                        pos = mm.find(old_bytes, offset)
+                    copy_range(f.fileno(), out, offset, size, mm)
+                return True
+    with open(path, "r", encoding="utf-8") as f:
+        current = f.read()
+    if old not in current:
+        return False
+    write_atomic(path, current.replace(old, new))
+    return True
+
+
 async def update_file(path: str, content: str, old_content: str = None) -> str:
     """Update a file (full overwrite or partial replace)."""
     if not path or content is None:
         return "Error: 'path' and 'content' are required."
     try:
         if old_content:
-            with open(path, "r", encoding="utf-8") as f:
-                current = f.read()
-            if old_content not in current:
+            if not replace_in_file(path, old_content, content):
                 return "Error: 'old_content' text block not found in file. Ensure exact match (including whitespace)."
-            content = current.replace(old_content, content)
-
-        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(content)
+        else:
+            write_in_dir(path, lambda: write_atomic(path, content))
         return f"Successfully updated {path}."
     except Exception as e:
         return f"Error updating file: {e}"
 
 
-async def save_clipboard_image() -> str | None:
-    """Save clipboard image to temp file. Returns path or None."""
-    temp_path = f"/tmp/clipboard_{int(time.time())}_{random.randint(1000, 9999)}.png"
-    commands = [
-        f'wl-paste -t image/png > "{temp_path}"',
-        f'xclip -selection clipboard -t image/png -o > "{temp_path}"',
-        f'pngpaste "{temp_path}"',
-    ]
-    for cmd in commands:
+# Commands that print the clipboard image as PNG on stdout (Wayland, X11, macOS)
+CLIPBOARD_COMMANDS = [
+    ("wl-paste", "-t", "image/png"),
+    ("xclip", "-selection", "clipboard", "-t", "image/png", "-o"),
+    ("pngpaste", "-"),
+]
+
+# Try the session's own clipboard tool first, so a paste usually costs one exec
+if os.environ.get("WAYLAND_DISPLAY"):
+    _preferred = "wl-paste"
+elif os.environ.get("DISPLAY"):
+    _preferred = "xclip"
+else:
+    _preferred = "pngpaste" if sys.platform == "darwin" else None
+CLIPBOARD_COMMANDS.sort(key=lambda argv: argv[0] != _preferred)
+
+_clipboard_command = None  # The command that last produced an image; it won't change mid-session
+
+
+async def read_clipboard_image() -> bytes | None:
+    """Clipboard image as PNG bytes, or None."""
+    global _clipboard_command
+    for argv in [_clipboard_command] if _clipboard_command else CLIPBOARD_COMMANDS:
         try:
-            subprocess.run(cmd, shell=True, check=True, capture_output=True)
-            if os.path.exists(temp_path) and os.path.getsize(temp_path) > 0:
-                return temp_path
-        except subprocess.CalledProcessError:
+            proc = await asyncio.create_subprocess_exec(*argv, stdout=PIPE, stderr=PIPE)
+            data, _ = await proc.communicate()
+        except OSError:  # Not installed
             continue
+        if proc.returncode == 0 and data:
+            _clipboard_command = argv
+            return data
     return None
 
 
+async def save_clipboard_image() -> str | None:
+    """Save clipboard image to temp file. Returns path or None."""
+    data = await read_clipboard_image()
+    if not data:
+        return None
+    temp_path = f"/tmp/clipboard_{int(time.time())}_{random.randint(1000, 9999)}.png"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    return temp_path
+
+
+ENCODE_CHUNK = 48 * 1024  # A multiple of 3, so encoded chunks concatenate without padding
+
+
+def encode_image(source: str | bytes) -> str:
+    """Base64 of raw image bytes or of a file, encoded chunk by chunk so the file is never held whole."""
+    if isinstance(source, bytes):
+        return base64.b64encode(source).decode("ascii")
+    encoded = bytearray()
+    with open(source, "rb") as f:
+        while chunk := f.read(ENCODE_CHUNK):
+            encoded += base64.b64encode(chunk)
+    return encoded.decode("ascii")
+
+
 async def describe_image(paths: list) -> str:
     """Describe images using LLM vision."""
     from .llm import call_llm
@@ -106,21 +249,41 @@ async def describe_image(paths: list) -> str:
     image_paths = paths if isinstance(paths, list) else [paths]
     content = [{"type": "text", "text": "Describe these images in detail."}]
 
+    # Clipboard images are encoded straight from memory, without a temp file round trip
+    sources = []
     for p in image_paths:
-        actual_path = await save_clipboard_image() if p == "clipboard" else p
-        if not actual_path:
+        source = await read_clipboard_image() if p == "clipboard" else p
+        if not source:
             return "Error reading from clipboard."
-        try:
-            with open(actual_path, "rb") as f:
-                b64 = base64.b64encode(f.read()).decode("utf-8")
-            content.append({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64}"}})
-        except Exception as e:
-            return f"Error reading image {p}: {e}"
+        sources.append(source)
+
+    # Read and encode every image concurrently in worker threads, off the event loop
+    encoded = await asyncio.gather(
+        *(asyncio.to_thread(encode_image, source) for source in sources), return_exceptions=True
+    )
+    for p, b64 in zip(image_paths, encoded):
+        if isinstance(b64, Exception):
+            return f"Error reading image {p}: {b64}"
+        content.append({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64}"}})
 
     response = await call_llm([{"role": "user", "content": content}], [])
     return response["message"]["content"]
 
 
+# Special trigger tool to enable grounding in providers. One shared list: the providers
+# cache their conversion and encoding of a tools list by identity.
+SEARCH_TRIGGER_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "__google_search_trigger__",
+            "description": "Trigger search",
+            "parameters": {"type": "object", "properties": {}},
+        },
+    }
+]
+
+
 async def google_search(query: str) -> str:
     """Perform a web search using Google Search grounding."""
     from .llm import call_llm
@@ -132,20 +295,8 @@ async def google_search(query: str) -> str:
         {"role": "system", "content": "Search the web and provide a detailed answer."},
         {"role": "user", "content": query},
     ]
-    # Special trigger tool to enable grounding in providers
-    tools = [
-        {
-            "type": "function",
-            "function": {
-                "name": "__google_search_trigger__",
-                "description": "Trigger search",
-                "parameters": {"type": "object", "properties": {}},
-            },
-        }
-    ]
-
     try:
-        response = await call_llm(messages, tools)
+        response = await call_llm(messages, SEARCH_TRIGGER_TOOLS)
         return response["message"]["content"]
     except Exception as e:
         return f"Error performing google search: {e}"
@@ -165,6 +316,9 @@ TOOLS = {
     "describe_image": describe_image,
 }
 
+# Tools without side effects: identical calls within one batch may share a result
+READ_ONLY_TOOLS = frozenset({"search_files", "search_string", "read_file", "google_search", "describe_image"})
+
 # ---------------------------------------------------------------------------
 # Tool Schemas (OpenAI-compatible format)
 # ---------------------------------------------------------------------------
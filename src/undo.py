@@ -1,36 +1,60 @@
 """Undo manager with Git and manual file tracking support."""
 
+import functools
 import os
-import copy
+import shutil
 import subprocess
 import logging
 
+from .utils import write_in_dir
+
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=1)
+def git_index_path() -> str | None:
+    """Index file of the enclosing git work tree, or None outside one (probed once per process)."""
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--is-inside-work-tree", "--git-path", "index"],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+    inside, index_path = result.stdout.splitlines()
+    return os.path.abspath(index_path) if inside == "true" else None
+
+
 class UndoManager:
     """Manages undo history using Git snapshots or manual file tracking."""
 
     def __init__(self):
         self.history = []
-        self.git_available = self._check_git()
-
-    def _check_git(self) -> bool:
-        """Check if we're inside a git repository."""
-        try:
-            subprocess.run(["git", "rev-parse", "--is-inside-work-tree"], check=True, capture_output=True)
-            return True
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            return False
+        self.index_path = git_index_path()
+        self.git_available = self.index_path is not None
+
+    def _scratch_index(self) -> dict:
+        """Environment pointing git at a fresh copy of the index.
+
+        Snapshots and restores stage into the copy, leaving the user's staging area untouched;
+        starting from the real index keeps its stat cache, so git only rehashes changed files.
+        """
+        scratch = self.index_path + ".undo"
+        if os.path.exists(self.index_path):
+            shutil.copyfile(self.index_path, scratch)
+        elif os.path.exists(scratch):
+            os.remove(scratch)
+        return {**os.environ, "GIT_INDEX_FILE": scratch}
 
     def _git_snapshot(self) -> str | None:
         """Create a git tree snapshot. Returns tree hash or None."""
         try:
-            subprocess.run(["git", "add", "-A"], check=True, capture_output=True)
-            result = subprocess.run(["git", "write-tree"], check=True, capture_output=True, text=True)
-            tree_hash = result.stdout.strip()
-            subprocess.run(["git", "reset"], check=True, capture_output=True)
-            return tree_hash
+            env = self._scratch_index()
+            subprocess.run(["git", "add", "-A"], check=True, capture_output=True, env=env)
+            result = subprocess.run(["git", "write-tree"], check=True, capture_output=True, text=True, env=env)
+            return result.stdout.strip()
         except Exception as e:
             logger.error(f"Git snapshot failed: {e}")
             return None
@@ -38,17 +62,22 @@ class UndoManager:
     def _git_restore(self, tree_hash: str) -> bool:
         """Restore working directory from a git tree hash."""
         try:
-            subprocess.run(["git", "checkout", tree_hash, "--", "."], check=True, capture_output=True)
-            subprocess.run(["git", "clean", "-fd"], check=True, capture_output=True)
-            subprocess.run(["git", "reset"], check=True, capture_output=True)
+            env = self._scratch_index()
+            subprocess.run(["git", "checkout", tree_hash, "--", "."], check=True, capture_output=True, env=env)
+            subprocess.run(["git", "clean", "-fd"], check=True, capture_output=True, env=env)
             return True
         except Exception as e:
             logger.error(f"Git restore failed: {e}")
             return False
 
     def start_turn(self, messages: list):
-        """Snapshot state at the start of a turn."""
-        snapshot = {"messages": copy.deepcopy(messages), "type": "manual", "data": {}}
+        """Snapshot state at the start of a turn.
+
+        Only the history length is kept: undo returns a slice sharing the original
+        message dicts. Messages before that length must not change afterwards, except
+        through record_replaced (history eviction), whose originals undo puts back.
+        """
+        snapshot = {"length": len(messages), "type": "manual", "data": {}, "replaced": {}}
 
         if self.git_available:
             tree_hash = self._git_snapshot()
@@ -58,6 +87,12 @@ class UndoManager:
 
         self.history.append(snapshot)
 
+    def record_replaced(self, originals: dict):
+        """Record messages the current turn replaced ({index: original}), for undo to restore."""
+        if self.history:
+            for i, msg in originals.items():
+                self.history[-1]["replaced"].setdefault(i, msg)
+
     def record_file_change(self, path: str):
         """Record file state before modification (for manual tracking)."""
         if not self.history or self.history[-1]["type"] == "git":
@@ -72,7 +107,7 @@ class UndoManager:
             except Exception:
                 pass
 
-    def undo(self) -> list | None:
+    def undo(self, messages: list) -> list | None:
         """Undo the last turn. Returns restored messages or None."""
         if not self.history:
             return None
@@ -90,10 +125,16 @@ class UndoManager:
                         if os.path.exists(path):
                             os.remove(path)
                     else:
-                        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
-                        with open(path, "w", encoding="utf-8") as f:
-                            f.write(content)
+
+                        def restore():
+                            with open(path, "w", encoding="utf-8") as f:
+                                f.write(content)
+
+                        write_in_dir(path, restore)
                 except Exception as e:
                     print(f"Error reverting file {path}: {e}")
 
-        return state["messages"]
+        restored = messages[: state["length"]]
+        for i, msg in state["replaced"].items():
+            restored[i] = msg
+        return restored
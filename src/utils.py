@@ -1,11 +1,68 @@
 """Utility functions."""
 
+import json
+import os
+
 from .config import config
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+CHAR_LIMIT = config.tool_output_limit * 4  # ~4 chars per token; config is fixed at startup
+
 
 def truncate_output(output: str) -> str:
     """Truncate output to configured limit."""
-    char_limit = config.tool_output_limit * 4
-    if len(output) > char_limit:
-        return output[:char_limit] + f"\n... (Output truncated. Total length: {len(output)} chars.)"
-    return output
+    if len(output) <= CHAR_LIMIT:
+        return output
+    return output[:CHAR_LIMIT] + f"\n... (Output truncated. Total length: {len(output)} chars.)"
+
+
+def json_loads(data: str | bytes):
+    """Parse JSON, using orjson when it is installed."""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj) -> str:
+    """Serialize to compact JSON, using orjson when it is installed."""
+    if orjson:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"))
+
+
+_fragments = {}  # id(obj) -> (obj, encoded); holding obj keeps its id from being reused
+
+
+def json_fragment(obj) -> str:
+    """Compact JSON for an object that is never mutated, encoded once per object."""
+    entry = _fragments.get(id(obj))
+    if entry is None or entry[0] is not obj:
+        if len(_fragments) >= 16:
+            _fragments.clear()
+        entry = _fragments[id(obj)] = (obj, json_dumps(obj))
+    return entry[1]
+
+
+_known_dirs = set()  # Directories already ensured to exist
+
+
+def write_in_dir(path: str, write):
+    """Call write() once path's parent directory exists, creating it if needed.
+
+    Directories seen before skip makedirs (and its stat calls); one removed since then
+    (say by a bash command) makes write() fail, and is recreated before a single retry.
+    """
+    directory = os.path.dirname(path) or "."
+    if directory in _known_dirs:
+        try:
+            return write()
+        except FileNotFoundError:
+            pass
+    os.makedirs(directory, exist_ok=True)
+    _known_dirs.add(directory)
+    return write()